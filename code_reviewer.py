@@ -1,52 +1,249 @@
-from dotenv import load_dotenv
-from portia import Portia, default_config, example_tool_registry, LLMProvider, LLMModel, StorageClass
 import time
 import json
+import functools
+import math
+import random
+from collections import deque, OrderedDict
+import hashlib
+import shelve
 import logging
-from rich.console import Console
+from logging.handlers import QueueHandler, QueueListener
+import queue
+import atexit
+from rich.console import Console, Group
+from rich.logging import RichHandler
+from rich.protocol import is_renderable
+from rich.pretty import Pretty
 from rich.panel import Panel
-from rich.syntax import Syntax
-from rich.markdown import Markdown
 import os
+import re
+import sys
+
+# Use orjson for faster parsing of large responses when it is installed
+try:
+    import orjson as _json
+except ImportError:
+    _json = json
 
-# Set up logging
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
 console = Console()
 
+# Set up logging. Records are still formatted in the calling thread, but the
+# writes happen on a background listener thread. They go through the shared
+# console so they print above any live progress bar instead of through it.
+_log_queue = queue.SimpleQueue()
+_log_listener = QueueListener(_log_queue, RichHandler(console=console))
+_queue_handler = QueueHandler(_log_queue)
+_queue_handler.setFormatter(logging.Formatter("%(message)s"))  # RichHandler adds time and level
+logging.basicConfig(level=logging.WARNING, handlers=[_queue_handler])
+_log_listener.start()
+atexit.register(_log_listener.stop)
+for noisy_logger in ("httpx", "portia"):
+    logging.getLogger(noisy_logger).setLevel(logging.WARNING)
+logger = logging.getLogger(__name__)
+
+# Persistent cache of completed reviews, keyed by review type and code hash
+REVIEW_CACHE_DIR = os.path.expanduser("~/.cache/code_reviewer")
+REVIEW_CACHE_PATH = os.path.join(REVIEW_CACHE_DIR, "reviews")
+
+# Finished reviews from this session, so repeats skip the on-disk cache
+SESSION_REVIEW_CACHE_SIZE = 32
+_session_reviews = OrderedDict()
+
+# Review instructions. These are kept free of interpolation and placed before
+# the code so every request of a type shares a byte-identical prompt prefix.
+GENERAL_PREFIX = """Review this code and provide a single, comprehensive analysis covering:
+- Code quality and best practices
+- Potential bugs and issues
+- Key improvements needed"""
+
+SECURITY_PREFIX = """Review this code for security issues and provide a single, comprehensive analysis covering:
+- Security vulnerabilities
+- Input validation issues
+- Key security improvements needed"""
+
+PERFORMANCE_PREFIX = """Review this code for performance issues and provide a single, comprehensive analysis covering:
+- Time and space complexity
+- Performance bottlenecks
+- Key optimization opportunities"""
+
+ALL_PREFIX = """Review this code and return a JSON object with keys 'general', 'security' and 'performance', each containing a single, comprehensive analysis:
+- general: code quality, best practices, potential bugs and key improvements needed
+- security: security vulnerabilities, input validation issues and key security improvements needed
+- performance: time and space complexity, performance bottlenecks and key optimization opportunities
+
+Return only the JSON object."""
+
+REVIEW_PREFIXES = {
+    "general": GENERAL_PREFIX,
+    "security": SECURITY_PREFIX,
+    "performance": PERFORMANCE_PREFIX,
+    "all": ALL_PREFIX,
+}
+
+# Error message fragments that indicate a rate limit error
+_RATE_LIMIT_RE = re.compile(r"rate limit|429|too many requests", re.IGNORECASE)
+
+# API budget per rolling minute
+PORTIA_RPM_LIMIT = 1
+PORTIA_TPM_LIMIT = 50000
+
+# Largest code payload sent in a single review, in estimated tokens
+MAX_SNIPPET_TOKENS = 6000
+
+# Snippets shorter than these (in characters) are reviewed by smaller models
+SMALL_MODEL_MAX_CHARS = 500
+MEDIUM_MODEL_MAX_CHARS = 5000
+
+# How long to hold off further requests after retries are exhausted
+RATE_LIMIT_COOLDOWN = 300
+
 def wait_with_message(seconds, message):
-    """Wait for specified seconds while showing a countdown message."""
-    for i in range(seconds, 0, -1):
-        console.print(f"\r{message} {i} seconds...", end="", soft_wrap=False)
-        time.sleep(1)
-    console.print("\r" + " " * 50 + "\r", end="", soft_wrap=False)
+    """Wait for specified seconds while showing a progress bar."""
+    if not console.is_terminal:
+        # Nothing to redraw when output is piped, so sleep in one go
+        time.sleep(seconds)
+        return
+    from rich.progress import Progress
+    
+    with Progress(console=console, transient=True) as progress:
+        task = progress.add_task(message, total=seconds)
+        deadline = time.monotonic() + seconds
+        while (remaining := deadline - time.monotonic()) > 0:
+            progress.update(task, completed=seconds - remaining)
+            time.sleep(min(0.25, remaining))
+
+class TokenBucket:
+    """Rate limiter over a rolling one-minute window of requests and tokens."""
+
+    def __init__(self, rpm, tpm, window=60.0):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.window = window
+        self._events = deque()  # [timestamp, tokens] per request in the window
+        self.cooldown_until = 0.0  # time.monotonic() before which no request is made
+
+    def _prune(self, now):
+        while self._events and now - self._events[0][0] >= self.window:
+            self._events.popleft()
+
+    def _wait_time(self, est_tokens, now):
+        """Return how long to wait before a request of est_tokens fits the budget."""
+        self._prune(now)
+        if now < self.cooldown_until:
+            return self.cooldown_until - now
+        if not self._events:
+            return 0.0
+        used_tokens = sum(tokens for _, tokens in self._events)
+        if len(self._events) < self.rpm and used_tokens + est_tokens <= self.tpm:
+            return 0.0
+        # Wait until enough of the oldest requests leave the window
+        excess_requests = len(self._events) - self.rpm + 1
+        excess_tokens = used_tokens + est_tokens - self.tpm
+        freed = 0
+        for i, (ts, tokens) in enumerate(self._events):
+            freed += tokens
+            if i + 1 >= excess_requests and freed >= excess_tokens:
+                return max(0.0, ts + self.window - now)
+        return max(0.0, self._events[-1][0] + self.window - now)
+
+    def acquire(self, est_tokens):
+        """Block only as long as needed, then record a request of est_tokens.
+
+        Returns a handle that can be passed to record() once the actual token
+        count is known.
+        """
+        while True:
+            wait = self._wait_time(est_tokens, time.monotonic())
+            if wait <= 0:
+                break
+            console.print(f"\n[yellow]Rate limit budget used, waiting {math.ceil(wait)} seconds...[/yellow]")
+            wait_with_message(wait, "Waiting")
+        event = [time.monotonic(), est_tokens]
+        self._events.append(event)
+        return event
+
+    def cool_down(self, seconds):
+        """Hold off all requests for the given number of seconds."""
+        self.cooldown_until = max(self.cooldown_until, time.monotonic() + seconds)
+
+    def discard(self, event):
+        """Remove an acquired request from the window."""
+        try:
+            self._events.remove(event)
+        except ValueError:
+            pass
+
+    def record(self, event, actual_tokens=None):
+        """Mark an acquired request as finished.
+
+        The request's window restarts from now, and its estimate is replaced
+        with the actual token count when one is given.
+        """
+        event[0] = time.monotonic()
+        if actual_tokens is not None:
+            event[1] = actual_tokens
+
+def estimate_tokens(text):
+    """Roughly estimate the number of tokens in text."""
+    return len(text) // 4
+
+def _renderable(obj):
+    """Convert an object to what console.print would render for it."""
+    if isinstance(obj, str):
+        return console.render_str(obj)
+    if is_renderable(obj):
+        return obj
+    return Pretty(obj)
+
+def _fit_snippet(code_snippet, max_tokens=None):
+    """Cut the middle out of a snippet that would exceed max_tokens.
+
+    The head and tail are kept, trimmed to whole lines, with a marker noting
+    how many lines were dropped.
+    """
+    if max_tokens is None:
+        max_tokens = MAX_SNIPPET_TOKENS
+    if estimate_tokens(code_snippet) <= max_tokens:
+        return code_snippet
+    budget = max_tokens * 4 // 2  # characters kept from each end
+    head = code_snippet[:budget]
+    tail = code_snippet[-budget:]
+    if "\n" in head:
+        head = head[:head.rfind("\n")]
+    if "\n" in tail:
+        tail = tail[tail.find("\n") + 1:]
+    # At least part of one line is always dropped, even without newlines
+    omitted = max(1, code_snippet.count("\n") - head.count("\n") - tail.count("\n") - 1)
+    return f"{head}\n# ... [truncated {omitted} lines] ...\n{tail}"
 
 def display_code_review(review_results):
     """Display the code review results in a user-friendly way."""
     try:
+        # Collect everything into one group so it is laid out and written once
+        renderables = []
         if hasattr(review_results, 'state'):
-            console.print(f"\n[bold]Review State:[/bold] {review_results.state}")
+            renderables.append(_renderable(f"\n[bold]Review State:[/bold] {review_results.state}"))
             
+        renderables.append(_renderable("\n[bold]Review Results:[/bold]"))
         if hasattr(review_results, 'outputs'):
-            console.print("\n[bold]Review Results:[/bold]")
             for output in review_results.outputs:
                 if hasattr(output, 'value'):
                     # Try to parse as JSON for structured output
                     try:
-                        value = json.loads(output.value)
+                        value = _json.loads(output.value)
                         if isinstance(value, dict):
                             for key, val in value.items():
-                                console.print(f"\n[bold]{key}:[/bold]")
-                                console.print(val)
+                                renderables.append(_renderable(f"\n[bold]{key}:[/bold]"))
+                                renderables.append(_renderable(val))
                         else:
-                            console.print(f"- {output.value}")
-                    except json.JSONDecodeError:
-                        console.print(f"- {output.value}")
+                            renderables.append(_renderable(f"- {output.value}"))
+                    except (_json.JSONDecodeError, ValueError):
+                        renderables.append(_renderable(f"- {output.value}"))
                 else:
-                    console.print(f"- {output}")
+                    renderables.append(_renderable(f"- {output}"))
         else:
-            console.print("\n[bold]Review Results:[/bold]")
-            console.print(review_results)
+            renderables.append(_renderable(review_results))
+        console.print(Group(*renderables))
             
     except Exception as e:
         console.print(f"\n[red]Error displaying results:[/red] {e}")
@@ -55,67 +252,194 @@ def display_code_review(review_results):
 
 def is_rate_limit_error(error_msg):
     """Check if the error is a rate limit error."""
-    rate_limit_indicators = [
-        "rate limit",
-        "429",
-        "too many requests",
-        "requests rate limit exceeded"
-    ]
-    return any(indicator in error_msg.lower() for indicator in rate_limit_indicators)
-
-def review_code(code_snippet, review_type="general"):
-    """Review a code snippet and return the results."""
+    return _RATE_LIMIT_RE.search(error_msg) is not None
+
+@functools.lru_cache(maxsize=4)
+def _get_portia(provider, model, storage):
+    """Build a Portia client once per (provider, model, storage) and reuse it."""
+    from portia import Portia, default_config, example_tool_registry
+    
+    # Create a custom config using the given provider, model and storage
+    config = default_config(
+        llm_provider=provider,
+        llm_model_name=model,
+        storage_class=storage
+    )
+    
+    # Instantiate a Portia client with the config and example tools
+    return Portia(config=config, tools=example_tool_registry)
+
+def _review_cache_key(review_type, code_snippet, model):
+    """Return the cache key for a review type, code snippet and model."""
+    return hashlib.sha256((review_type + "\0" + str(model) + "\0" + code_snippet).encode()).hexdigest()
+
+def _remember_review(key, plan_run):
+    """Keep a finished review in memory, evicting the least recently used."""
+    _session_reviews[key] = plan_run
+    _session_reviews.move_to_end(key)
+    if len(_session_reviews) > SESSION_REVIEW_CACHE_SIZE:
+        _session_reviews.popitem(last=False)
+
+@functools.lru_cache(maxsize=1)
+def _ensure_cache_dir():
+    """Create the review cache directory once per session."""
+    os.makedirs(REVIEW_CACHE_DIR, exist_ok=True)
+
+def _load_cached(*keys):
+    """Return the stored review or plan for each key, or None, in one read."""
     try:
-        # Create a custom config using Mistral AI and local storage
-        config = default_config(
-            llm_provider=LLMProvider.MISTRALAI,
-            llm_model_name=LLMModel.MISTRAL_LARGE,
-            storage_class=StorageClass.MEMORY
-        )
-        
-        # Instantiate a Portia client with Mistral config and example tools
-        portia = Portia(config=config, tools=example_tool_registry)
-        
-        # Create a more focused review query to reduce API calls
-        if review_type == "general":
-            query = f"""Review this code and provide a single, comprehensive analysis covering:
-- Code quality and best practices
-- Potential bugs and issues
-- Key improvements needed
+        _ensure_cache_dir()
+        with shelve.open(REVIEW_CACHE_PATH) as cache:
+            return [cache.get(key) for key in keys]
+    except Exception as e:
+        logger.warning(f"Could not read review cache: {e}")
+        return [None] * len(keys)
 
-Code:
-{code_snippet}"""
-        elif review_type == "security":
-            query = f"""Review this code for security issues and provide a single, comprehensive analysis covering:
-- Security vulnerabilities
-- Input validation issues
-- Key security improvements needed
+def _store_cached(key, value):
+    """Store a completed review or plan under the key."""
+    try:
+        _ensure_cache_dir()
+        with shelve.open(REVIEW_CACHE_PATH) as cache:
+            cache[key] = value
+    except Exception as e:
+        logger.warning(f"Could not write review cache: {e}")
 
-Code:
-{code_snippet}"""
-        elif review_type == "performance":
-            query = f"""Review this code for performance issues and provide a single, comprehensive analysis covering:
-- Time and space complexity
-- Performance bottlenecks
-- Key optimization opportunities
+def _get_plan(portia, review_type, code_snippet, plan_key, stored_plan):
+    """Return the stored plan for the review, only planning if there is none."""
+    if stored_plan is not None:
+        # Register the stored plan so the client can look it up while running
+        storage = getattr(portia, "storage", None)
+        if storage is not None:
+            storage.save_plan(stored_plan)
+        return stored_plan
+    
+    # Static instructions first so providers can cache the shared prefix
+    if review_type not in REVIEW_PREFIXES:
+        raise ValueError(f"Unknown review type: {review_type}")
+    query = REVIEW_PREFIXES[review_type] + "\n\nCode:\n" + _fit_snippet(code_snippet)
+    
+    console.print("\n[bold]Generating review plan...[/bold]")
+    plan = portia.plan(query)
+    _store_cached(plan_key, plan)
+    return plan
 
-Code:
-{code_snippet}"""
-        
-        # Generate and execute plan
-        console.print("\n[bold]Generating review plan...[/bold]")
-        plan = portia.plan(query)
+def _select_model(code_snippet):
+    """Pick the smallest Mistral model suited to the size of the snippet."""
+    from portia import LLMModel
+    
+    if len(code_snippet) < SMALL_MODEL_MAX_CHARS:
+        name = "MISTRAL_SMALL"
+    elif len(code_snippet) < MEDIUM_MODEL_MAX_CHARS:
+        name = "MISTRAL_MEDIUM"
+    else:
+        name = "MISTRAL_LARGE"
+    model = getattr(LLMModel, name, None)
+    if model is None:
+        # Fall back to Large if this Portia version doesn't offer the smaller model
+        logger.warning(f"LLMModel.{name} is not available in this Portia version, using MISTRAL_LARGE")
+        model = LLMModel.MISTRAL_LARGE
+    console.print(f"\n[bold]Model:[/bold] {model.name}")
+    return model
+
+def _build_portia(model=None):
+    """Return the shared Mistral AI client with local storage."""
+    # Portia pulls in the Mistral SDK, httpx and pydantic, so only import it
+    # once a review is actually requested
+    from portia import LLMProvider, LLMModel, StorageClass
+    
+    if model is None:
+        model = LLMModel.MISTRAL_LARGE
+    return _get_portia(LLMProvider.MISTRALAI, model, StorageClass.MEMORY)
+
+def review_code(code_snippet, review_type="general", model=None):
+    """Review a code snippet and return the results.
+
+    If no model is given, one is chosen based on the size of the snippet.
+    """
+    if model is None:
+        model = _select_model(code_snippet)
+    return _rate_limited_review(_build_portia(model), model, code_snippet, review_type)
+
+def _run_review(portia, code_snippet, review_type, cache_key, stored_plan):
+    """Review a code snippet with an existing Portia client.
+
+    cache_key is where the finished run is stored, and stored_plan is a plan
+    already loaded from the cache for this review, if any.
+    """
+    try:
+        # Reuse the plan for identical reviews, then execute it
+        plan = _get_plan(portia, review_type, code_snippet, "plan:" + cache_key, stored_plan)
         
         console.print("\n[bold]Executing review...[/bold]")
         plan_run = portia.run_plan(plan)
+        
+        # Only cache runs that finished successfully
+        if str(getattr(plan_run, "state", "")).endswith("COMPLETE"):
+            _store_cached(cache_key, plan_run)
+            _remember_review(cache_key, plan_run)
         return plan_run
         
     except Exception as e:
         logger.error(f"Error in code review: {e}")
         raise
 
+def read_code_snippet():
+    """Read a code snippet from stdin until EOF.
+
+    Piped input is read in a single bulk read. On a terminal, lines are
+    collected as they arrive so Ctrl+C keeps whatever was already entered.
+    """
+    if not sys.stdin.isatty():
+        return sys.stdin.read().rstrip("\n")
+    lines = []
+    try:
+        for line in sys.stdin:
+            lines.append(line)
+    except KeyboardInterrupt:
+        pass
+    return "".join(lines).rstrip("\n")
+
+rate_limiter = TokenBucket(PORTIA_RPM_LIMIT, PORTIA_TPM_LIMIT)
+
+def _rate_limited_review(portia, model, code_snippet, review_type):
+    """Wait for rate limit budget, run a review and record its token usage."""
+    cache_key = _review_cache_key(review_type, code_snippet, model)
+    cached = _session_reviews.get(cache_key)
+    stored_plan = None
+    if cached is None:
+        # One read of the on-disk cache serves both the finished review and its plan
+        cached, stored_plan = _load_cached(cache_key, "plan:" + cache_key)
+    if cached is not None:
+        _remember_review(cache_key, cached)
+        # Cached reviews make no API request, so they never wait for budget
+        console.print("\n[bold]Using cached review...[/bold]")
+        return cached
+    
+    # Only the truncated snippet is sent, so only it counts against the budget
+    sent_snippet = _fit_snippet(code_snippet)
+    event = rate_limiter.acquire(est_tokens=estimate_tokens(sent_snippet) + 512)
+    try:
+        review_results = _run_review(portia, code_snippet, review_type, cache_key, stored_plan)
+    except Exception as e:
+        if is_rate_limit_error(str(e)):
+            # Drop the rejected request so the caller's jittered backoff is
+            # the only wait before retrying
+            rate_limiter.discard(event)
+        else:
+            rate_limiter.record(event)
+        raise
+    
+    # Count the request from when it finished
+    actual_tokens = None
+    if hasattr(review_results, 'outputs'):
+        response_text = "".join(str(getattr(o, 'value', o)) for o in review_results.outputs)
+        actual_tokens = estimate_tokens(sent_snippet + response_text) + 512
+    rate_limiter.record(event, actual_tokens)
+    return review_results
+
 def main():
     # Load environment variables
+    from dotenv import load_dotenv
     load_dotenv()
     
     try:
@@ -133,53 +457,51 @@ def main():
             console.print("2. Security Review (vulnerabilities, input validation)")
             console.print("3. Performance Review (complexity, optimization)")
             console.print("4. Exit")
+            console.print("5. Full Review (general, security and performance in one request)")
             
-            choice = input("\nSelect review type (1-4): ")
+            choice = input("\nSelect review type (1-5): ")
             
             if choice == "4":
                 break
                 
-            if choice not in ["1", "2", "3"]:
+            if choice not in ["1", "2", "3", "5"]:
                 console.print("[red]Invalid choice. Please try again.[/red]")
                 continue
                 
             review_type = {
                 "1": "general",
                 "2": "security",
-                "3": "performance"
+                "3": "performance",
+                "5": "all"
             }[choice]
             
             console.print("\n[bold]Enter your code snippet (press Ctrl+D or Ctrl+Z when done):[/bold]")
-            code_lines = []
-            try:
-                while True:
-                    line = input()
-                    code_lines.append(line)
-            except (EOFError, KeyboardInterrupt):
-                pass
-                
-            code_snippet = "\n".join(code_lines)
+            code_snippet = read_code_snippet()
             
             if not code_snippet.strip():
                 console.print("[red]No code provided. Please try again.[/red]")
                 continue
                 
             # Display the code with syntax highlighting
-            syntax = Syntax(code_snippet, "python", theme="monokai")
+            from rich.syntax import Syntax
+            syntax = Syntax(code_snippet, "python", theme="monokai", line_numbers=False, word_wrap=False)
             console.print(Panel(syntax, title="Code to Review", border_style="green"))
             
             max_retries = 3
             retry_count = 0
             base_wait_time = 60  # Increased from 30 to 60 seconds
+            model = None
+            portia = None
             
             while retry_count < max_retries:
                 try:
-                    # Add initial delay before first attempt
-                    if retry_count == 0:
-                        console.print("\n[yellow]Waiting 60 seconds before starting review (rate limit protection)...[/yellow]")
-                        wait_with_message(60, "Waiting")
+                    # Build the client once; retries reuse it
+                    if portia is None:
+                        model = _select_model(code_snippet)
+                        portia = _build_portia(model)
                     
-                    review_results = review_code(code_snippet, review_type)
+                    # Reviews only wait if the rate limit budget is used up
+                    review_results = _rate_limited_review(portia, model, code_snippet, review_type)
                     display_code_review(review_results)
                     break
                     
@@ -189,10 +511,12 @@ def main():
                     
                     if is_rate_limit_error(error_msg):
                         retry_count += 1
-                        # Exponential backoff: 60s, 120s, 240s
-                        wait_time = base_wait_time * (2 ** (retry_count - 1))
+                        # Equal-jitter exponential backoff: 30-60s, 60-120s, 120-240s,
+                        # so clients hitting the same limit don't retry in lockstep
+                        backoff = base_wait_time * (2 ** (retry_count - 1))
+                        wait_time = backoff / 2 + random.uniform(0, backoff / 2)
                         console.print(f"\n[yellow]Rate limit reached. Attempt {retry_count} of {max_retries}[/yellow]")
-                        console.print(f"Waiting {wait_time} seconds before retrying (exponential backoff)...")
+                        console.print(f"Waiting {wait_time:.0f} seconds before retrying (exponential backoff)...")
                         wait_with_message(wait_time, "Waiting")
                         continue
                     else:
@@ -201,12 +525,10 @@ def main():
             
             if retry_count >= max_retries:
                 console.print("\n[red]Maximum retries reached. Please try again later.[/red]")
-                console.print("[yellow]Tip: Wait at least 5 minutes before trying again to avoid rate limits.[/yellow]")
-                break  # Exit the program to prevent further rate limit issues
-            
-            # Add a longer delay between successful requests
-            console.print("\n[yellow]Waiting 60 seconds before next request...[/yellow]")
-            wait_with_message(60, "Waiting")
+                console.print("[yellow]The next review will wait at least 5 minutes to avoid rate limits.[/yellow]")
+                # Keep the session and its caches; just hold off the next request
+                rate_limiter.cool_down(RATE_LIMIT_COOLDOWN)
+                continue
 
     except Exception as e:
         console.print(f"[red]Error:[/red] {e}")